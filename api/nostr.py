@@ -1,12 +1,84 @@
-import pygeohash
+import asyncio
+import functools
 import hashlib
+import logging
 import uuid
 
+import pygeohash
+
 from secp256k1 import PrivateKey
-from asgiref.sync import sync_to_async
 from nostr_sdk import Keys, Client, EventBuilder, NostrSigner, Kind, Tag, PublicKey
 from api.models import Order
 from decouple import config
+from django.core.cache import cache
+
+logger = logging.getLogger("api.nostr")
+
+NOSTR_NSEC = config("NOSTR_NSEC", cast=str, default="")
+NOSTR_ENABLED = NOSTR_NSEC != ""
+COORDINATOR_ALIAS = config("COORDINATOR_ALIAS", cast=str, default="NoAlias")
+COORDINATOR_ALIAS_LOWER = COORDINATOR_ALIAS.lower()
+NETWORK = config("NETWORK", cast=str, default="mainnet")
+HOST_NAME = config("HOST_NAME", cast=str, default="")
+DISABLE_ONCHAIN = config("DISABLE_ONCHAIN", cast=bool, default=True)
+STRFRY_PORT = config("STRFRY_PORT", cast=str, default="7778")
+
+# Order event tags that are the same for every order
+TAG_AMOUNT = Tag.parse(["amt", "0"])
+TAG_PLATFORM = Tag.parse(["y", "robosats", COORDINATOR_ALIAS_LOWER])
+TAG_NETWORK = Tag.parse(["network", NETWORK])
+TAG_ORDER_TYPE = Tag.parse(["z", "order"])
+SOURCE_URL_PREFIX = f"http://{HOST_NAME}/order/{COORDINATOR_ALIAS_LOWER}/"
+LAYERS_LIGHTNING = ("lightning",)
+LAYERS_ONCHAIN_LIGHTNING = ("onchain", "lightning")
+
+# Notification event status tags, one per order status
+TAGS_STATUS = {status: Tag.parse(["status", str(status)]) for status in Order.Status}
+
+# Fingerprint of the last published event of each order. Kept in the shared
+# cache so every celery worker process compares against what the relay holds.
+ORDER_EVENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Connected clients reused across events, keyed by coordinator pubkey
+nostr_clients = {}
+
+
+@functools.lru_cache(maxsize=1)
+def get_keys(nsec: str) -> Keys:
+    """Parsed coordinator Keys, cached per NSEC value"""
+    return Keys.parse(nsec)
+
+
+@functools.lru_cache(maxsize=1)
+def get_public_key_hex(nsec: str) -> str:
+    """Hex pubkey of the coordinator Keys, cached per NSEC value"""
+    return get_keys(nsec).public_key().to_hex()
+
+
+@functools.lru_cache(maxsize=1)
+def get_private_key(nsec: str) -> PrivateKey:
+    """secp256k1 PrivateKey used for schnorr signing, cached per NSEC value"""
+    return PrivateKey(bytes.fromhex(get_keys(nsec).secret_key().to_hex()))
+
+
+@functools.lru_cache(maxsize=4096)
+def get_public_key(hex_pubkey: str) -> PublicKey:
+    """Parsed robot PublicKey, cached since a robot gets several notifications per order"""
+    return PublicKey.parse(hex_pubkey)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_order_d_tag(alias: str, order_id: int) -> str:
+    """Stable "d" tag of an order event, derived from the coordinator alias and order id"""
+    # md5 is kept so the tag of already published orders does not change
+    digest = hashlib.md5(f"{alias}{order_id}".encode("utf-8")).digest()
+    return str(uuid.UUID(bytes=digest))
+
+
+@functools.lru_cache(maxsize=4096)
+def get_geohash(latitude: float, longitude: float) -> str:
+    """Geohash of an order location, cached for orders that get republished"""
+    return pygeohash.encode(latitude, longitude)
 
 
 class Nostr:
@@ -15,108 +87,114 @@ class Nostr:
     async def send_order_event(self, order):
         """Creates the event and sends it to the coordinator relay"""
 
+        if not NOSTR_ENABLED:
+            return
+
         # Publish only public orders
         if order.password is not None:
             return
 
-        if config("NOSTR_NSEC", cast=str, default="") == "":
+        # Skip signing and sending if the event would be identical to the last one
+        cache_key = f"nostr_order_event_{order.id}"
+        fingerprint = self.get_order_fingerprint(order)
+        if await cache.aget(cache_key) == fingerprint:
+            logger.debug("Nostr ORDER event unchanged, not sending")
             return
 
-        print("Sending nostr ORDER event")
+        logger.debug("Sending nostr ORDER event")
 
-        keys = Keys.parse(config("NOSTR_NSEC", cast=str))
-        client = await self.initialize_client(keys)
+        keys = get_keys(NOSTR_NSEC)
 
-        robot_name = await self.get_user_name(order)
-        robot_hash_id = await self.get_robot_hash_id(order)
-        currency = await self.get_robot_currency(order)
+        client = await self.initialize_client(NOSTR_NSEC)
+        robot_name, robot_hash_id, currency = self.get_order_context(order)
 
         content = order.description if order.description is not None else ""
 
-        event = (
-            EventBuilder(Kind(38383), content)
-            .tags(self.generate_tags(order, robot_name, robot_hash_id, currency))
-            .sign_with_keys(keys)
+        builder = EventBuilder(Kind(38383), content).tags(
+            self.generate_tags(order, robot_name, robot_hash_id, currency)
         )
-        await client.send_event(event)
-        print(f"Nostr ORDER event sent: {event.as_json()}")
+        # Schnorr signing is CPU bound, keep it off the event loop thread
+        event = await asyncio.to_thread(builder.sign_with_keys, keys)
+        output = await client.send_event(event)
+
+        # send_event does not raise on rejected events or unreachable relays, only
+        # remember the event as published if every relay accepted it
+        if output.success and not output.failed:
+            await cache.aset(cache_key, fingerprint, ORDER_EVENT_CACHE_TIMEOUT)
+        else:
+            logger.warning("Nostr ORDER event not published: %s", output.failed)
+
+        # Skip serializing the event unless it is going to be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Nostr ORDER event sent: %s", event.as_json())
 
     async def send_notification_event(self, robot, order, text):
         """Creates the notification event and sends it to the coordinator relay"""
-        if config("NOSTR_NSEC", cast=str, default="") == "":
+        if not NOSTR_ENABLED:
             return
 
-        print("Sending nostr NOTIFICATION event")
+        logger.debug("Sending nostr NOTIFICATION event")
 
-        keys = Keys.parse(config("NOSTR_NSEC", cast=str))
-        client = await self.initialize_client(keys)
+        client = await self.initialize_client(NOSTR_NSEC)
 
         tags = [
             Tag.parse(
                 [
                     "order_id",
-                    f"{config('COORDINATOR_ALIAS', cast=str).lower()}/{order.id}",
+                    f"{COORDINATOR_ALIAS_LOWER}/{order.id}",
                 ]
             ),
-            Tag.parse(["status", str(order.status)]),
+            TAGS_STATUS[order.status],
         ]
 
-        await client.send_private_msg(PublicKey.parse(robot.nostr_pubkey), text, tags)
-        print("Nostr NOTIFICATION event sent")
+        await client.send_private_msg(get_public_key(robot.nostr_pubkey), text, tags)
+        logger.debug("Nostr NOTIFICATION event sent")
 
-    async def initialize_client(self, keys):
-        # Initialize with coordinator Keys
-        signer = NostrSigner.keys(keys)
-        client = Client(signer)
+    async def initialize_client(self, nsec):
+        """Returns a connected client for the coordinator keys, built once and reused"""
+        pubkey = get_public_key_hex(nsec)
+        client = nostr_clients.get(pubkey)
+        if client is None:
+            # Initialize with coordinator Keys
+            signer = NostrSigner.keys(get_keys(nsec))
+            client = Client(signer)
 
-        # Add relays and connect
-        await client.add_relay("ws://localhost:7777")
-        strfry_port = config("STRFRY_PORT", cast=str, default="7778")
-        await client.add_relay(f"ws://localhost:{strfry_port}")
-        await client.connect()
+            # Add relays
+            await client.add_relay("ws://localhost:7777")
+            await client.add_relay(f"ws://localhost:{STRFRY_PORT}")
 
-        return client
+            # A concurrent call may have stored its client meanwhile, keep that one
+            client = nostr_clients.setdefault(pubkey, client)
 
-    @sync_to_async
-    def get_user_name(self, order):
-        return order.maker.username
+        # Only (re)connects relays that are not connected already
+        await client.connect()
 
-    @sync_to_async
-    def get_robot_hash_id(self, order):
-        return order.maker.robot.hash_id
+        return client
 
-    @sync_to_async
-    def get_robot_currency(self, order):
-        return str(order.currency)
+    def get_order_context(self, order):
+        """Maker username, robot hash id and currency of the order.
+        The order must be loaded with select_related("maker__robot", "currency"),
+        related objects can not be lazily fetched from async code."""
+        return order.maker.username, order.maker.robot.hash_id, str(order.currency)
 
     def generate_tags(self, order, robot_name, robot_hash_id, currency):
-        hashed_id = hashlib.md5(
-            f"{config('COORDINATOR_ALIAS', cast=str)}{order.id}".encode("utf-8")
-        ).hexdigest()
+        if order.has_range:
+            amounts = (str(order.min_amount), str(order.max_amount))
+        else:
+            amounts = (str(order.amount),)
+        payment_methods = order.payment_method.split(" ")
 
         tags = [
-            Tag.parse(["d", str(uuid.UUID(hashed_id))]),
+            Tag.parse(["d", get_order_d_tag(COORDINATOR_ALIAS, order.id)]),
             Tag.parse(["name", robot_name, robot_hash_id]),
             Tag.parse(["k", "sell" if order.type == Order.Types.SELL else "buy"]),
             Tag.parse(["f", currency]),
             Tag.parse(["s", self.get_status_tag(order)]),
-            Tag.parse(["amt", "0"]),
-            Tag.parse(
-                ["fa"]
-                + (
-                    [str(order.amount)]
-                    if not order.has_range
-                    else [str(order.min_amount), str(order.max_amount)]
-                )
-            ),
-            Tag.parse(["pm"] + order.payment_method.split(" ")),
+            TAG_AMOUNT,
+            Tag.parse(["fa", *amounts]),
+            Tag.parse(["pm", *payment_methods]),
             Tag.parse(["premium", str(order.premium)]),
-            Tag.parse(
-                [
-                    "source",
-                    f"http://{config('HOST_NAME')}/order/{config('COORDINATOR_ALIAS', cast=str).lower()}/{order.id}",
-                ]
-            ),
+            Tag.parse(["source", f"{SOURCE_URL_PREFIX}{order.id}"]),
             Tag.parse(
                 [
                     "expiration",
@@ -124,20 +202,45 @@ class Nostr:
                     str(order.escrow_duration),
                 ]
             ),
-            Tag.parse(["y", "robosats", config("COORDINATOR_ALIAS", cast=str).lower()]),
-            Tag.parse(["network", str(config("NETWORK"))]),
-            Tag.parse(["layer"] + self.get_layer_tag(order)),
+            TAG_PLATFORM,
+            TAG_NETWORK,
+            Tag.parse(["layer", *self.get_layer_tag(order)]),
             Tag.parse(["bond", str(order.bond_size)]),
-            Tag.parse(["z", "order"]),
+            TAG_ORDER_TYPE,
         ]
 
-        if order.latitude and order.longitude:
-            tags.extend(
-                [Tag.parse(["g", pygeohash.encode(order.latitude, order.longitude)])]
+        latitude, longitude = order.latitude, order.longitude
+        if latitude is not None and longitude is not None:
+            tags.append(
+                Tag.parse(["g", get_geohash(float(latitude), float(longitude))])
             )
 
         return tags
 
+    def get_order_fingerprint(self, order):
+        """Digest of the order fields that end up in its event content and tags.
+        Stable across processes, unlike the builtin salted hash()."""
+        fields = repr(
+            (
+                int(order.status),
+                int(order.type),
+                order.currency_id,
+                order.amount,
+                order.has_range,
+                order.min_amount,
+                order.max_amount,
+                order.premium,
+                order.payment_method,
+                order.expires_at,
+                order.escrow_duration,
+                order.bond_size,
+                order.latitude,
+                order.longitude,
+                order.description,
+            )
+        )
+        return hashlib.blake2b(fields.encode("utf-8"), digest_size=16).hexdigest()
+
     def get_status_tag(self, order):
         if order.status == Order.Status.PUB:
             return "pending"
@@ -145,19 +248,19 @@ class Nostr:
             return "success"
 
     def get_layer_tag(self, order):
-        if order.type == Order.Types.SELL and not config(
-            "DISABLE_ONCHAIN", cast=bool, default=True
-        ):
-            return ["onchain", "lightning"]
+        if order.type == Order.Types.SELL and not DISABLE_ONCHAIN:
+            return LAYERS_ONCHAIN_LIGHTNING
         else:
-            return ["lightning"]
-            return False
+            return LAYERS_LIGHTNING
 
+    @staticmethod
     def sign_message(text: str) -> str:
+        """Schnorr signs the text with the coordinator key, empty string if unavailable"""
+        if not NOSTR_ENABLED:
+            return ""
+
         try:
-            keys = Keys.parse(config("NOSTR_NSEC", cast=str))
-            secret_key_hex = keys.secret_key().to_hex()
-            private_key = PrivateKey(bytes.fromhex(secret_key_hex))
+            private_key = get_private_key(NOSTR_NSEC)
             signature = private_key.schnorr_sign(
                 text.encode("utf-8"), bip340tag=None, raw=True
             )
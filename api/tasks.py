@@ -256,9 +256,14 @@ def cache_market():
 def nostr_send_order_event(order_id=None):
     if order_id:
         from api.models import Order
-        from api.nostr import Nostr
+        from api.nostr import NOSTR_ENABLED, Nostr
 
-        order = Order.objects.get(id=order_id)
+        if not NOSTR_ENABLED:
+            return
+
+        order = Order.objects.select_related("maker__robot", "currency").get(
+            id=order_id
+        )
 
         nostr = Nostr()
         async_to_sync(nostr.send_order_event)(order)
@@ -270,7 +275,10 @@ def nostr_send_order_event(order_id=None):
 def nostr_send_notification_event(robot_id=None, order_id=None, text=None):
     if order_id:
         from api.models import Robot, Order
-        from api.nostr import Nostr
+        from api.nostr import NOSTR_ENABLED, Nostr
+
+        if not NOSTR_ENABLED:
+            return
 
         robot = Robot.objects.get(id=robot_id)
         order = Order.objects.get(id=order_id)
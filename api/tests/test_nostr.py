@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock, patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from api.models import Order
+from api.nostr import Nostr, get_order_d_tag
+
+
+def make_order(**fields):
+    order = SimpleNamespace(
+        id=1234,
+        password=None,
+        status=Order.Status.PUB,
+        type=Order.Types.BUY,
+        currency_id=1,
+        amount=Decimal("100"),
+        has_range=False,
+        min_amount=None,
+        max_amount=None,
+        premium=Decimal("1.50"),
+        payment_method="Revolut SEPA",
+        expires_at=datetime(2026, 1, 1, tzinfo=timezone.utc),
+        escrow_duration=10800,
+        bond_size=Decimal("3.00"),
+        latitude=None,
+        longitude=None,
+        description=None,
+    )
+    order.__dict__.update(fields)
+    return order
+
+
+SENT = SimpleNamespace(
+    success={"ws://localhost:7777", "ws://localhost:7778"}, failed={}
+)
+NOT_SENT = SimpleNamespace(
+    success=set(), failed={"ws://localhost:7777": "relay not connected"}
+)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+@patch("api.nostr.NOSTR_ENABLED", True)
+@patch("api.nostr.get_keys", Mock())
+@patch("api.nostr.EventBuilder", Mock())
+@patch.object(Nostr, "generate_tags", Mock(return_value=[]))
+@patch.object(Nostr, "get_order_context", Mock(return_value=("name", "hash", "USD")))
+class TestNostrOrderEvent(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.relay_client = Mock(send_event=AsyncMock(return_value=SENT))
+        patcher = patch.object(
+            Nostr, "initialize_client", AsyncMock(return_value=self.relay_client)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_unchanged_order_is_skipped(self):
+        order = make_order()
+        await Nostr().send_order_event(order)
+        await Nostr().send_order_event(order)
+
+        self.assertEqual(self.relay_client.send_event.await_count, 1)
+
+    async def test_status_round_trip_is_sent_again(self):
+        order = make_order()
+        await Nostr().send_order_event(order)
+        order.status = Order.Status.PAU
+        await Nostr().send_order_event(order)
+        order.status = Order.Status.PUB
+        await Nostr().send_order_event(order)
+
+        self.assertEqual(self.relay_client.send_event.await_count, 3)
+
+    async def test_failed_send_is_not_recorded(self):
+        # nostr_sdk reports relay failures in the send output instead of raising
+        order = make_order()
+        self.relay_client.send_event.return_value = NOT_SENT
+        await Nostr().send_order_event(order)
+
+        self.relay_client.send_event.return_value = SENT
+        await Nostr().send_order_event(order)
+        await Nostr().send_order_event(order)
+
+        self.assertEqual(self.relay_client.send_event.await_count, 2)
+
+
+class TestNostrOrderTags(TestCase):
+    def test_order_d_tag_is_stable(self):
+        # Baseline uuid.UUID(md5(f"{alias}{order_id}").hexdigest()). The d tag
+        # addresses the replaceable order event, it must never change.
+        self.assertEqual(
+            get_order_d_tag("Local Dev", 1234),
+            "d982f658-137f-7b9c-1568-60d31be73d1f",
+        )
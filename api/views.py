@@ -64,7 +64,6 @@ from api.utils import (
     get_robosats_commit,
     verify_signed_message,
 )
-from api.nostr import Nostr
 from chat.models import Message
 from control.models import AccountingDay, BalanceLog
 
@@ -1024,6 +1023,9 @@ class ReviewView(APIView):
         if request.user.robot.nostr_pubkey != pubkey:
             return Response(new_error(1052), status.HTTP_400_BAD_REQUEST)
 
+        # Imported here so the nostr_sdk extension only loads when a review is signed
+        from api.nostr import Nostr
+
         token = Nostr.sign_message(f"{pubkey}{last_order.id}")
 
         return Response({"pubkey": pubkey, "token": token}, status.HTTP_200_OK)